@@ -10,18 +10,30 @@ Then, it builds the system call with the corresponding command line options and
 it creates a subprocess that launches mibio via the command line interface (CLI)
 
 Since mibio still opens the GUI and keeps it open after the process is finished,
-the script waits for a period of time (controlled by the `timeout_sec` variable).
-After the time as finished, the script checks for the existence of the output TIFF
-file and measures the change in its file size.  The program exits if the output
-TIFF is not generated or not finished after the timeout. If the TIFF integrity
-check passes, a subfolder is created for the output files from mibio. The config
-and output log files from mibio are stored in this subfolder as well to keep track
-of the parameters used for the generation and bg subtraction.
+the script waits until the mibio process exits or the output TIFF file is written,
+or for at most a period of time (controlled by the `timeout_sec` variable). After
+a timeout, the output TIFF is only accepted if its size and modification time
+stay unchanged for `output_settle_sec` seconds; otherwise mibio is killed and the
+job fails, since the TIFF could be truncated. After the wait is over, the script
+checks for the existence of the output TIFF file and measures its file size. The
+program exits if the output TIFF is not generated or is empty after the wait. If
+the TIFF integrity check passes, a subfolder is created for the output files from
+mibio. The config and output log files from mibio are stored in this subfolder as
+well to keep track of the parameters used for the generation and bg subtraction.
+The files of a failed job (including a possibly truncated TIFF) are moved to the
+`failed` subfolder instead, so that the next jobs can still run.
+The mibio instances left running with the GUI open are closed (killed) at the end
+of the sweep, once all the jobs are done.
 
 The script can be used to iteratively generate TIFFs over arrays of background
 thresholds for different subtraction methods. This is accomplished via repeated
 calls to the mibio CLI; TIFFs with different parameters are saved separately in
 their corresponding subdirectory.
+The threshold combinations are processed one at a time with asyncio, and each
+job writes its own copy of the config file, which is installed as the mibio config
+file right before launching mibio. The jobs can't run concurrently: mibio reads
+the shared config file at a time of its choosing and every job writes the same
+output TIFF and launch log.
 
 TODO: Add option to save parameter file in subdirectory (txt file will do)
 
@@ -37,18 +49,40 @@ where `PID` is the process id number output when starting nohup
 """
 
 import sys
+import os
+import ctypes
+import struct
 import pathlib
+import itertools
+import asyncio
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import shutil
 import shlex
-from subprocess import Popen, PIPE
-import time
 from datetime import datetime
 import json
-import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 # inputs in 'params_bg.py'
 import params_bg as params
 
+# messages are queued by the jobs and written to stdout by a single listener thread
+logger = logging.getLogger('mibio_ctrl')
+
+# set up the logger and start its listener, which should be stopped at the end
+def setup_logging():
+    log_queue = queue.Queue()
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    return listener
+
 # dictionary of background removal terms
 bg_dict = {
     'events' : 'event',
@@ -56,173 +90,410 @@ bg_dict = {
     'Ta' : 'tantalum'
 }
 
-# printing background removal process
-def print_loops(bg_removal_type : str, thresh):
-    print()
+# seconds the output file size and modification time must stay unchanged to be complete after a timeout
+output_settle_sec = 5
+
+# position of the first fov (Point0) among the children of the run element (root[0]) of the xml file
+point_offset = 3
+
+# thresholds to loop over for a bg removal type: only the first one is used if the type is not selected
+def active_thresholds(bg_removal_type : str, thresholds):
+    if not params.remove_slide_bg or bg_removal_type not in params.bg_removal_types:
+        return thresholds[:1]
+    return thresholds
+
+# logging background removal process
+def log_loops(bg_removal_type : str, thresholds):
+    logger.info('')
     if not params.remove_slide_bg:
-        print('No bg removal selected')
+        logger.info('No bg removal selected')
     elif params.remove_slide_bg and bg_removal_type not in params.bg_removal_types:
-        print(f'No looping over {bg_dict[bg_removal_type]} thresholds required')
+        logger.info(f'No looping over {bg_dict[bg_removal_type]} thresholds required')
     else:
-        print(f'Looping over {bg_dict[bg_removal_type]} threshold: {thresh}')
+        logger.info(f'Looping over {bg_dict[bg_removal_type]} thresholds: {thresholds}')
 
-# editing config file before mibio call
-def edit_config(bg_thres_ev,bg_thres_au,bg_thres_ta):
-    with open(params.config_file_path, 'r+') as config_file:
+# state shared by the jobs of the threshold sweep:
+# mibio command arguments and their printable version (the same for all the jobs), parsed mibio config data
+# and the launched mibio processes, which may keep running with the GUI open until the end of the sweep
+mibio_argv = []
+mibio_cmd = ''
+config_data = {}
+mibio_procs = []
+
+# set up the state shared by the jobs of the threshold sweep
+def init_sweep(argv, json_data):
+    global mibio_argv, mibio_cmd, config_data, mibio_procs
+    mibio_argv = argv
+    # printable version of the command
+    mibio_cmd = ' '.join(shlex.quote(arg) for arg in argv)
+    config_data = json_data
+    mibio_procs = []
+
+# per-job copy of the mibio config file, kept with the outputs of the job
+def job_config_path(bg_thres_ev,bg_thres_au,bg_thres_ta):
+    config_file_path = params.config_file_path
+    return config_file_path.with_name(f'{config_file_path.stem}.{bg_thres_ev}_{bg_thres_au}_{bg_thres_ta}{config_file_path.suffix}')
+
+# reading the mibio config file once, with the settings common to all the jobs
+def read_config(config_file_path : pathlib.Path):
+    with open(config_file_path, 'r') as config_file:
         json_data = json.load(config_file)
-        # select mass window
-        json_data['Generator.DefaultMassStart'] = -0.3
-        json_data['Generator.DefaultMassStop'] = 0.0
-        # initialize the auto bg removal options (no bg removal)
-        json_data['Generator.BackgroundRemovalAuto.events'] = False
-        json_data['Generator.BackgroundRemovalAuto.197'] = False
-        json_data['Generator.BackgroundRemovalAuto.181'] = False
-        # initialize the bg thresholds (high threshold => no bg removal)
-        json_data['Generator.BackgroundRemovalValue.events'] = 1000000
-        json_data['Generator.BackgroundRemovalValue.197'] = 1000000
-        json_data['Generator.BackgroundRemovalValue.181'] = 1000000
-        # select slide bg removal type
-        if not params.remove_slide_bg:
-            output_subdir_name = 'bg_none'
-        else:
-            output_subdir_name = 'bg'
-            if params.use_default_slide_bg_removal_pars:
-                output_subdir_name += '_default'
-            if 'autoevents' in params.bg_removal_types:
-                json_data['Generator.BackgroundRemovalAuto.events'] = True
-                if not params.use_default_slide_bg_removal_pars:
-                    output_subdir_name += '_autoevents'
-            if 'autoAu' in params.bg_removal_types:
-                json_data['Generator.BackgroundRemovalAuto.197'] = True
-                if not params.use_default_slide_bg_removal_pars:
-                    output_subdir_name += '_autoau'
-            if 'autoTa' in params.bg_removal_types:
-                json_data['Generator.BackgroundRemovalAuto.181'] = True
-                if not params.use_default_slide_bg_removal_pars:
-                    output_subdir_name += '_autota'
-            if 'events' in params.bg_removal_types:
-                json_data['Generator.BackgroundRemovalValue.events'] = bg_thres_ev
-                if not params.use_default_slide_bg_removal_pars:
-                    output_subdir_name += f'_events_{bg_thres_ev:03}'
-            if 'Au' in params.bg_removal_types:
-                json_data['Generator.BackgroundRemovalValue.197'] = bg_thres_au
-                if not params.use_default_slide_bg_removal_pars:
-                    output_subdir_name += f'_au_{bg_thres_au:03}'
-            if 'Ta' in params.bg_removal_types:
-                json_data['Generator.BackgroundRemovalValue.181'] = bg_thres_ta
-                if not params.use_default_slide_bg_removal_pars:
-                    output_subdir_name += f'_ta_{bg_thres_ta:03}'
-        config_file.seek(0)
-        json.dump(json_data, config_file, indent=4)
-        config_file.truncate()
-        return output_subdir_name
+    # select mass window
+    json_data['Generator.DefaultMassStart'] = -0.3
+    json_data['Generator.DefaultMassStop'] = 0.0
+    return json_data
+
+# name of the output subdirectory for a set of bg removal parameters
+def get_subdir_name(bg_removal_types, bg_thres_ev, bg_thres_au, bg_thres_ta, use_default_pars : bool, remove_slide_bg : bool):
+    if not remove_slide_bg:
+        return 'bg_none'
+    parts = ['bg']
+    if use_default_pars:
+        parts.append('_default')
+    else:
+        for bg_method, part in (('autoevents', '_autoevents'),
+                                ('autoAu', '_autoau'),
+                                ('autoTa', '_autota'),
+                                ('events', f'_events_{bg_thres_ev:03}'),
+                                ('Au', f'_au_{bg_thres_au:03}'),
+                                ('Ta', f'_ta_{bg_thres_ta:03}')):
+            if bg_method in bg_removal_types:
+                parts.append(part)
+    return ''.join(parts)
+
+# editing config data before mibio call; the edited config is written to the per-job config file
+def edit_config(json_data,bg_thres_ev,bg_thres_au,bg_thres_ta,job_config_file_path):
+    # initialize the auto bg removal options (no bg removal)
+    json_data['Generator.BackgroundRemovalAuto.events'] = False
+    json_data['Generator.BackgroundRemovalAuto.197'] = False
+    json_data['Generator.BackgroundRemovalAuto.181'] = False
+    # initialize the bg thresholds (high threshold => no bg removal)
+    json_data['Generator.BackgroundRemovalValue.events'] = 1000000
+    json_data['Generator.BackgroundRemovalValue.197'] = 1000000
+    json_data['Generator.BackgroundRemovalValue.181'] = 1000000
+    # select slide bg removal type
+    if params.remove_slide_bg:
+        if 'autoevents' in params.bg_removal_types:
+            json_data['Generator.BackgroundRemovalAuto.events'] = True
+        if 'autoAu' in params.bg_removal_types:
+            json_data['Generator.BackgroundRemovalAuto.197'] = True
+        if 'autoTa' in params.bg_removal_types:
+            json_data['Generator.BackgroundRemovalAuto.181'] = True
+        if 'events' in params.bg_removal_types:
+            json_data['Generator.BackgroundRemovalValue.events'] = bg_thres_ev
+        if 'Au' in params.bg_removal_types:
+            json_data['Generator.BackgroundRemovalValue.197'] = bg_thres_au
+        if 'Ta' in params.bg_removal_types:
+            json_data['Generator.BackgroundRemovalValue.181'] = bg_thres_ta
+    # write to a temporary file first, so that the config file is replaced atomically
+    tmp_file_path = job_config_file_path.with_suffix(f'{job_config_file_path.suffix}.tmp.{os.getpid()}')
+    tmp_file_path.write_bytes(json.dumps(json_data, indent=4).encode())
+    os.replace(tmp_file_path, job_config_file_path)
+
+# copy a file with an in-kernel copy (sendfile), falling back to shutil where it is not supported
+def copy_file(src_path : str, dst_path : str):
+    try:
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+    except (AttributeError, OSError):
+        shutil.copyfile(src_path, dst_path)
+
+# inotify flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# watch a directory for files that are done being written (Linux only)
+# returns the inotify file descriptor, or None if inotify is not available
+def watch_dir(dir_path : str):
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (AttributeError, OSError):
+        return None
+    if inotify_fd < 0:
+        return None
+    if libc.inotify_add_watch(inotify_fd, os.fsencode(dir_path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(inotify_fd)
+        return None
+    return inotify_fd
+
+# names of the files in the pending inotify events
+def read_inotify_names(inotify_fd : int):
+    try:
+        buffer = os.read(inotify_fd, 64*1024)
+    except BlockingIOError:
+        return []
+    names = []
+    offset = 0
+    while offset < len(buffer):
+        # struct inotify_event: wd, mask, cookie, len, name[len]
+        _, _, _, name_len = struct.unpack_from('iIII', buffer, offset)
+        offset += 16
+        names.append(os.fsdecode(buffer[offset:offset+name_len].rstrip(b'\0')))
+        offset += name_len
+    return names
+
+# wait until the mibio process exits or the output file is written, for at most timeout_sec
+# the output file is watched with inotify when available; returns whether the wait timed out
+async def wait_for_output(proc : asyncio.subprocess.Process, output_name : str, inotify_fd, timeout_sec : float):
+    loop = asyncio.get_running_loop()
+    exit_task = asyncio.ensure_future(proc.wait())
+    waiters = {exit_task}
+    if inotify_fd is not None:
+        output_written = loop.create_future()
+        def check_output_written():
+            if output_name in read_inotify_names(inotify_fd) and not output_written.done():
+                output_written.set_result(True)
+        loop.add_reader(inotify_fd, check_output_written)
+        waiters.add(output_written)
+    try:
+        done, _ = await asyncio.wait(waiters, timeout=timeout_sec, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if inotify_fd is not None:
+            loop.remove_reader(inotify_fd)
+    if not exit_task.done():
+        # mibio keeps the GUI open after writing the output
+        exit_task.cancel()
+    return not done
+
+# check that the output file is not empty and no longer being written, with two stats settle_sec apart
+# needed after a timeout, when no close event tells that mibio is done with the output file
+async def output_is_stable(output_file : str, settle_sec : float):
+    try:
+        stat_before = os.stat(output_file, follow_symlinks=False)
+        await asyncio.sleep(settle_sec)
+        stat_after = os.stat(output_file, follow_symlinks=False)
+    except FileNotFoundError:
+        return False
+    if stat_after.st_size <= 0:
+        return False
+    return (stat_after.st_size, stat_after.st_mtime_ns) == (stat_before.st_size, stat_before.st_mtime_ns)
+
+# move the output TIFF (if any), the launch log and the job config file of a job to a subdirectory
+def move_outputs(output_dir_path : str, output_file : str, output_log_file : str, job_config_file : str, config_file_name : str):
+    logger.info(f'mkdir {output_dir_path}')
+    os.makedirs(output_dir_path, exist_ok=True)
+    if os.path.exists(output_file):
+        os.replace(output_file, os.path.join(output_dir_path, os.path.basename(output_file)))
+    os.replace(output_log_file, os.path.join(output_dir_path, os.path.basename(output_log_file)))
+    os.replace(job_config_file, os.path.join(output_dir_path, config_file_name))
 
 # run call to mibio cli
-def run(mibio_path : pathlib.Path, mibio_cmd : str, timeout_sec : float, output_subdir_name : str, config_file_path : pathlib.Path, log_file_path : pathlib.Path, output_file_path : pathlib.Path):
+async def run(mibio_path : pathlib.Path, mibio_argv : list, mibio_cmd : str, timeout_sec : float, output_subdir_name : str, config_file_path : pathlib.Path, job_config_file_path : pathlib.Path, log_file_path : pathlib.Path, output_file_path : pathlib.Path):
+    # paths are handled as plain strings from here on
+    output_parent = str(output_file_path.parent)
+    output_name = output_file_path.name
+    output_file = str(output_file_path)
+    job_config_file = str(job_config_file_path)
+
     # output file shouldn't exist
-    if output_file_path.exists():
-        print(f'WARNING! Output file {output_file_path} exists!')
-        print('Terminating...')
+    if os.path.exists(output_file):
+        logger.warning(f'WARNING! Output file {output_file} exists!')
+        logger.info('Terminating...')
+        os.remove(job_config_file)
         return 0
 
-    # create log file
-    output_log_file_path = output_file_path.parent.joinpath('out.launch_mibio.log')
-    output_log_file = output_log_file_path.open(mode='r+')
+    # create log file (line buffered), mibio stdout+stderr are written directly to it
+    output_log_name = 'out.launch_mibio.log'
+    output_log_file_path = os.path.join(output_parent, output_log_name)
+    output_log_file = open(output_log_file_path, 'w', buffering=1)
 
-    # redirect stdout+stderr to log file
-    save_stdout, save_stderr = sys.stdout, sys.stderr
-    sys.stdout = sys.stderr = output_log_file
+    inotify_fd = None
+    try:
+        # log date+time
+        start_msg = f'start date: {datetime.now()}'
+        logger.info(start_msg)
+        output_log_file.write(start_msg + '\n')
 
-    # print date+time
-    print(f'start date: {datetime.now()}')
+        # watch for the output file before launching mibio, so that its completion is not missed
+        inotify_fd = watch_dir(output_parent)
 
-    # print and run command
-    print(mibio_cmd)
-    proc = Popen(shlex.split(mibio_cmd), stdout=PIPE, stderr=PIPE)
-    print(f'process ID: {proc.pid}')
-    time.sleep(timeout_sec)
+        # log and run command
+        logger.info(mibio_cmd)
+        output_log_file.write(mibio_cmd + '\n')
+        # mibio only reads the shared config file: install the job config right before launching
+        tmp_config_file = f'{config_file_path}.tmp.{os.getpid()}'
+        copy_file(job_config_file, tmp_config_file)
+        os.replace(tmp_config_file, str(config_file_path))
+        proc = await asyncio.create_subprocess_exec(*mibio_argv, stdout=output_log_file, stderr=asyncio.subprocess.STDOUT)
+        mibio_procs.append(proc)
+        pid_msg = f'process ID: {proc.pid}'
+        logger.info(pid_msg)
+        output_log_file.write(pid_msg + '\n')
+        timed_out = await wait_for_output(proc, output_name, inotify_fd, timeout_sec)
+        # failed outputs are moved away, so that the output file doesn't stop the next jobs
+        failed_dir_path = os.path.join(output_parent, 'failed', output_subdir_name)
+        if timed_out and not await output_is_stable(output_file, output_settle_sec):
+            # the output is missing or still being written: don't file a truncated TIFF
+            logger.info(f'Timeout: killing process {proc.pid}')
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            output_log_file.close()
+            logger.error('Failed')
+            move_outputs(failed_dir_path, output_file, output_log_file_path, job_config_file, config_file_path.name)
+            return 0
+        output_log_file.close()
 
-    # probe output file size for 'finish signal'
-    output_file_size = 0
-    for i in range(params.n_trials):
+        # probe output file size for 'finish signal'
+        # the wait ends when mibio closes the output file or exits, or the output is stable after a timeout,
+        # so a single stat is enough
         try:
-            output_file_size = output_file_path.stat().st_size
-            break
+            output_file_size = os.stat(output_file, follow_symlinks=False).st_size
         except FileNotFoundError:
             output_file_size = -1
-            time.sleep(timeout_sec/10)
-    if output_file_size <= 0:
-        print('Failed')
-        return 0
-    time.sleep(timeout_sec/10)
-    output_file_size = output_file_path.stat().st_size
-    print(f'output file size: {output_file_size}')
-
-    # redirect output to previous states
-    sys.stdout, sys.stderr = save_stdout, save_stderr
-    print(output_log_file.read())
-    output_log_file.close()
-
-    # copy/move relevant outputs to subdirectory
-    output_dir_path = output_file_path.parent.joinpath(output_subdir_name)
-    print(f'mkdir {output_dir_path}')
-    output_dir_path.mkdir()
-    final_output_file_path = output_dir_path.joinpath(output_file_path.name)
-    output_file_path.replace(final_output_file_path)
-    final_output_log_path = output_dir_path.joinpath(output_log_file_path.name)
-    output_log_file_path.replace(final_output_log_path)
-    final_config_file_path = output_dir_path.joinpath(config_file_path.name)
-    shutil.copyfile(str(config_file_path), str(final_config_file_path))
-    final_log_file_path = output_dir_path.joinpath(log_file_path.name)
-    shutil.copyfile(str(log_file_path),str(final_log_file_path))
-    # WARNING: the log being copied is the full mibio log, not just the log in relation to this job
-    return 1
-
-# main process - loops over bg arrays and assembles commands to mibio cli
+        if output_file_size <= 0:
+            logger.error('Failed')
+            move_outputs(failed_dir_path, output_file, output_log_file_path, job_config_file, config_file_path.name)
+            return 0
+        logger.info(f'output file size: {output_file_size}')
+
+        # copy/move relevant outputs to subdirectory
+        output_dir_path = os.path.join(output_parent, output_subdir_name)
+        move_outputs(output_dir_path, output_file, output_log_file_path, job_config_file, config_file_path.name)
+        copy_file(str(log_file_path), os.path.join(output_dir_path, log_file_path.name))
+        # WARNING: the log being copied is the full mibio log, not just the log in relation to this job
+        return 1
+    finally:
+        # also release the job resources when the job stops on an error
+        output_log_file.close()
+        if inotify_fd is not None:
+            os.close(inotify_fd)
+        # the job config file is only left if it was not moved with the outputs
+        if os.path.exists(job_config_file):
+            os.remove(job_config_file)
+
+# read the names of the selected fovs from the run xml file
+# the xml is streamed and cleared as it is parsed, and parsing stops once all the selected fovs are found
+def read_point_names(xml_path : pathlib.Path, fov_nums):
+    wanted = {fov_num + point_offset: fov_num for fov_num in fov_nums}
+    names = {}
+    depth = 0
+    run_num = -1
+    child_num = -1
+    for event, elem in ET.iterparse(str(xml_path), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                run_num += 1
+            elif depth == 3 and run_num == 0:
+                child_num += 1
+                if child_num in wanted:
+                    names[wanted[child_num]] = elem.attrib['PointName']
+                    if len(names) == len(wanted):
+                        break
+        else:
+            depth -= 1
+            if depth == 2:
+                elem.clear()
+    return names
+
+# process one (events, Au, Ta) threshold combination of the sweep
+async def run_one(combo):
+    bg_thres_ev, bg_thres_au, bg_thres_ta = combo
+    logger.info('')
+    logger.info(f'Thresholds (events, Au, Ta): {combo}')
+    job_config_file_path = job_config_path(bg_thres_ev,bg_thres_au,bg_thres_ta)
+    edit_config(config_data,bg_thres_ev,bg_thres_au,bg_thres_ta,job_config_file_path)
+    output_subdir_name = get_subdir_name(params.bg_removal_types, bg_thres_ev, bg_thres_au, bg_thres_ta, params.use_default_slide_bg_removal_pars, params.remove_slide_bg)
+
+    job_status = await run(params.mibio_path, mibio_argv, mibio_cmd, params.timeout_sec, output_subdir_name, params.config_file_path, job_config_file_path, params.log_file_path, params.output_file_path)
+
+    if job_status:
+        logger.info('Job Done')
+    return job_status
+
+# watch the exit of the mibio processes through their pidfds, registered in the event loop (a single
+# epoll on Linux), instead of one waiting thread per process; python >= 3.12 already does this by default
+# NOTE: this only has an effect on python 3.9-3.11 (os.pidfd_open and asyncio.PidfdChildWatcher were added
+# in 3.9); on older versions, such as the python 3.7 of environment.yml, asyncio's default watcher is used
+def watch_children_with_pidfds(loop):
+    if sys.version_info >= (3, 12):
+        return None
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+        watcher = asyncio.PidfdChildWatcher()
+    except (AttributeError, OSError):
+        return None
+    watcher.attach_loop(loop)
+    asyncio.set_child_watcher(watcher)
+    return watcher
+
+# process the threshold combinations one after the other
+async def sweep(combos, argv, json_data):
+    watcher = watch_children_with_pidfds(asyncio.get_running_loop())
+    init_sweep(argv, json_data)
+    job_statuses = []
+    try:
+        for combo in combos:
+            job_statuses.append(await run_one(combo))
+    finally:
+        # also when a job raises (e.g. if mibio can't be launched)
+        await close_mibio_procs()
+        if watcher is not None:
+            watcher.attach_loop(None)
+    return job_statuses
+
+# close the mibio instances left running with the GUI open, once all their outputs are filed
+# (they would otherwise be killed anyway when their asyncio transports are finalized at exit)
+async def close_mibio_procs():
+    for proc in mibio_procs:
+        if proc.returncode is None:
+            logger.info(f'Closing mibio process {proc.pid}')
+            proc.kill()
+        await proc.wait()
+
+# main process - runs the threshold sweep with the logger listener running
 def main():
-    tree = ET.parse(str(params.xml_path))
-    root = tree.getroot()
-
-    fovs = []
-    for fov_num in params.fovs:
-        fovs.append(f"Point{fov_num}-{root[0][fov_num+3].attrib['PointName']}")
-    if not params.output_tiff_path.is_dir():
-        params.output_tiff_path.mkdir()
+    log_listener = setup_logging()
+    try:
+        sweep_thresholds()
+    finally:
+        log_listener.stop()
+
+# loops over bg arrays and assembles commands to mibio cli
+def sweep_thresholds():
+    point_names = read_point_names(params.xml_path, params.fovs)
+    fovs = [f"Point{fov_num}-{point_names[fov_num]}" for fov_num in params.fovs]
+    params.output_tiff_path.mkdir(parents=True, exist_ok=True)
     
     valid_bg_methods = ['events', 'Au', 'Ta', 'autoevents', 'autoAu', 'autoTa']
 
     for bg_method in params.bg_removal_types:
         if bg_method not in valid_bg_methods:
-            print('Failed')
+            logger.error('Failed')
             raise ValueError(f'Invalid bg method: {bg_method}')
 
     if params.remove_slide_bg:
-        print(f'Selected bg methods: {params.bg_removal_types}')
-
-    for bg_thres_ev in params.bg_thresholds_ev:
-        print_loops('events',bg_thres_ev)
-        for bg_thres_au in params.bg_thresholds_au:
-            print_loops('Au',bg_thres_au)
-            for bg_thres_ta in params.bg_thresholds_ta:
-                print_loops('Ta', bg_thres_ta)
-                print()
-                output_subdir_name = edit_config(bg_thres_ev,bg_thres_au,bg_thres_ta)
-
-                cmd = (str(params.mibio_path) + ' generate_tiff ' + str(params.xml_path) + ' ' + str(params.panel_path) + ' ' + str(params.fov_size) + ' --fovs ' + ' '.join(fovs))
-                cmd += f' --remove_slide_background {params.remove_slide_bg}'
-                cmd += f' --mass_recal {params.recalibrate_mass}'
-
-                job_status = run(params.mibio_path, cmd, params.timeout_sec, output_subdir_name, params.config_file_path, params.log_file_path, params.output_file_path)
-
-                if job_status:
-                    print('Job Done')
-                if not params.remove_slide_bg or 'Ta' not in params.bg_removal_types:
-                    break
-            if not params.remove_slide_bg or 'Au' not in params.bg_removal_types:
-                break
-        if not params.remove_slide_bg or 'events' not in params.bg_removal_types:
-            break
+        logger.info(f'Selected bg methods: {params.bg_removal_types}')
+
+    # only loop over the thresholds of the selected bg removal types
+    bg_thresholds_ev = active_thresholds('events', params.bg_thresholds_ev)
+    bg_thresholds_au = active_thresholds('Au', params.bg_thresholds_au)
+    bg_thresholds_ta = active_thresholds('Ta', params.bg_thresholds_ta)
+    log_loops('events', bg_thresholds_ev)
+    log_loops('Au', bg_thresholds_au)
+    log_loops('Ta', bg_thresholds_ta)
+    combos = list(itertools.product(bg_thresholds_ev, bg_thresholds_au, bg_thresholds_ta))
+
+    # the mibio command doesn't depend on the thresholds, so it is assembled only once
+    # as an argument list, which is passed to mibio without going through a shell
+    argv = [str(params.mibio_path), 'generate_tiff', str(params.xml_path), str(params.panel_path), str(params.fov_size), '--fovs', *fovs]
+    argv += ['--remove_slide_background', str(params.remove_slide_bg)]
+    argv += ['--mass_recal', str(params.recalibrate_mass)]
+
+    # each combination is moved to its own subdirectory once its job is done
+    asyncio.run(sweep(combos, argv, read_config(params.config_file_path)))
 
-    print('Finished loop over thresholds')
+    logger.info('Finished loop over thresholds')
 
-main()
+if __name__ == '__main__':
+    main()
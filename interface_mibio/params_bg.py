@@ -29,4 +29,3 @@ bg_removal_types =                  ['events', 'Au', 'Ta']
 
 # safe timeouts around 180 times the number of fovs
 timeout_sec =                       180*len(fovs)
-n_trials =                          3                           
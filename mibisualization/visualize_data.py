@@ -1,11 +1,14 @@
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
+from PIL import Image
+
 from mibidata import tiff, mibi_image as mi, combine_tiffs
 
 #GRAPH_DEBUG = 1
@@ -14,6 +17,9 @@ GRAPH_DEBUG = 0
 #SAVE = True
 SAVE = False
 
+#SAVE_PNGS = True
+SAVE_PNGS = False
+
 # known masses
 mass_NA = 22.99
 mass_Y = 88.91
@@ -21,6 +27,9 @@ mass_TA = 180.95
 mass_AU = 196.97
 # ref: https://en.wikipedia.org/wiki/Periodic_table
 
+# color lookup tables of the color maps used so far, by name
+dict_cmap_luts = {}
+
 # TODO: implement unit tests at least for the utility functions!!!
 
 
@@ -81,7 +90,10 @@ def plot_rb_image(red_channel, blue_channel, title='', ax=None,
     ax2 : `~matplotlib.axes.Axes`
         Axes of the figure containing the rb plot
     """
-    dim=np.zeros(blue_channel.shape)
+    # float32 is precise enough for display and halves the memory traffic
+    red_channel = red_channel.astype(np.float32, copy=False)
+    blue_channel = blue_channel.astype(np.float32, copy=False)
+    dim=np.zeros(blue_channel.shape, np.float32)
     
     B = np.stack((dim,blue_channel/2,blue_channel/2),axis=2)
     R = np.stack((red_channel,dim,dim),axis=2)
@@ -187,7 +199,8 @@ def plot_image(data, title='', ax=None,
         If activated, a gamma correction of 1/2 is applied to the image. In this
         case, the color scale is not meaningful, so no color scale bar is shown.
     hi_res: bool, optional
-        This parameter controls the size and resolution of the plotted image:
+        This parameter controls the size and resolution of the new figure
+        created when no axes are given:
         * False will set the size to 8x8 (medium size image).
         * True wil set the resolution to 250 dpi (large image).
     style_kwargs : dict, optional
@@ -200,16 +213,16 @@ def plot_image(data, title='', ax=None,
     image : `~matplotlib.image.AxesImage`
     """
     # create plot
-    if not hi_res:
-        fig = plt.figure(figsize=(8, 8)) # medium size images
-    else:
-        #fig = plt.figure(dpi=300) # high resolution (very large images)
-        fig = plt.figure(dpi=250) # medium-high resolution (large images)
-    do_not_close_fig = False
     if ax is None:
+        if not hi_res:
+            fig = plt.figure(figsize=(8, 8)) # medium size images
+        else:
+            #fig = plt.figure(dpi=300) # high resolution (very large images)
+            fig = plt.figure(dpi=250) # medium-high resolution (large images)
         ax = fig.add_subplot(111)
-        # if no axis object is passed by ref, the figure should remain open
-        do_not_close_fig = True
+    else:
+        # plot in the figure of the axes passed by ref, no need for a new one
+        fig = ax.figure
     if style_kwargs is None:
         style_kwargs = dict()
 
@@ -221,7 +234,9 @@ def plot_image(data, title='', ax=None,
     # image might need some brightening method to enhance contrast
     if (brighten_image):
         # apply gamma
-        data = np.power(data, 1/2)
+        # (in place on a float32 copy, the caller's array is not modified)
+        data = data.astype(np.float32)
+        np.sqrt(data, out=data)
         #data = np.power(data, 0.3)
         # in this case, the color scale is not meaningful
 
@@ -244,12 +259,135 @@ def plot_image(data, title='', ax=None,
         cax = divider.append_axes("right", size="5%", pad=0.05)
         fig.colorbar(image, cax=cax, label='counts')
 
-    if not do_not_close_fig:
-        # close figure to avoid white canvases
-        plt.close(fig)
     return ax, image
 
 
+def get_cmap_lut(cmap):
+    """Get the lookup table of a color map.
+
+    The tables of color maps given by name are computed once and cached.
+
+    Parameters
+    ----------
+    cmap : str or `~matplotlib.colors.Colormap`
+        Color map.
+
+    Returns
+    -------
+    lut : `~numpy.ndarray`
+        Colors of the color map (uint8 RGBA), one row per color.
+    """
+    if not isinstance(cmap, str):
+        return cmap(np.arange(cmap.N), bytes=True)
+
+    if cmap not in dict_cmap_luts:
+        dict_cmap_luts[cmap] = get_cmap_lut(plt.get_cmap(cmap))
+    return dict_cmap_luts[cmap]
+
+
+def make_scratch(shape):
+    """Allocate the scratch buffers for coloring images of a given shape.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the 2-D images to color.
+
+    Returns
+    -------
+    scratch : tuple of `~numpy.ndarray`
+        Buffers for the brightened image (float32) and the color indices
+        (uint8).
+    """
+    return (np.empty(shape, np.float32),
+            np.empty(shape, np.uint8))
+
+
+def color_indices(data, n_colors, brighten_image=False, scratch=None):
+    """Compute the color map indices of 2-D image.
+
+    The indices are the ones used by
+    `cmap(Normalize(vmin=0, vmax=data.max())(data))` for a color map with
+    `n_colors` colors, computed in float32 (with the gamma, on the square root
+    of the data in float32). For float64 images, a few pixels at the color
+    boundaries may get the neighboring color.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        2-D image data to color.
+    n_colors : int
+        Number of colors of the color map, at most 256.
+    brighten_image: bool, optional
+        If activated, a gamma correction of 1/2 is applied to the image.
+    scratch : tuple of `~numpy.ndarray`, optional
+        Buffers from `make_scratch(data.shape)`, to be reused when coloring
+        many images of the same shape. By default, new buffers are allocated.
+
+    Returns
+    -------
+    indices : `~numpy.ndarray`
+        Color indices (uint8), the second buffer of `scratch`.
+    """
+    if scratch is None:
+        scratch = make_scratch(data.shape)
+    data_f, indices = scratch
+
+    if brighten_image:
+        # apply gamma (in float32 also for small integer types, which numpy
+        # would otherwise take the square root of in float16)
+        np.sqrt(data, out=data_f, dtype=np.float32)
+    else:
+        np.copyto(data_f, data)
+
+    # same operations and order as Normalize and the color map call
+    vmax = data_f.max()
+    if vmax > 0:
+        data_f /= vmax
+        data_f *= n_colors
+        np.minimum(data_f, n_colors - 1, out=data_f)
+    np.copyto(indices, data_f, casting='unsafe')
+
+    return indices
+
+
+def save_image(data, file_name, brighten_image=False, cmap='afmhot',
+               scratch=None):
+    """Save 2-D image as a png file, one pixel per data pixel.
+
+    The image is written directly with Pillow, without creating a matplotlib
+    figure, as a palette png: one byte per pixel holding the color index, and
+    the colors of the color map in the palette. Since png is lossless at any
+    zlib level, the fastest compression level is used.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        2-D image data to save.
+    file_name : str
+        Path to the output png file.
+    brighten_image: bool, optional
+        If activated, a gamma correction of 1/2 is applied to the image.
+    cmap : str or `~matplotlib.colors.Colormap`, optional
+        Color map for the image, with at most 256 colors.
+    scratch : tuple of `~numpy.ndarray`, optional
+        Buffers from `make_scratch(data.shape)`, to be reused when saving many
+        images of the same shape. By default, new buffers are allocated.
+    """
+    lut = get_cmap_lut(cmap)
+    indices = color_indices(data, len(lut), brighten_image=brighten_image,
+                            scratch=scratch)
+
+    height, width = data.shape
+    image = Image.frombuffer('P', (width, height), indices, 'raw', 'P', 0, 1)
+    image.putpalette(lut[:, :3].tobytes())
+    save_kwargs = dict()
+    if (lut[:, 3] < 255).any():
+        # keep the transparency of the color map
+        save_kwargs['transparency'] = lut[:, 3].tobytes()
+    image.save(file_name, format='PNG', compress_level=1, **save_kwargs)
+
+
 def read_spectrum_from_csv(spectrum_file):
     """Read spectrum from a csv file and convert to appropriate format.
 
@@ -356,42 +494,31 @@ def read_panel_from_csv(panel_file, anonymize_targets=False):
     """
     panel_df = pd.read_csv(panel_file)
 
-    try:
-        panel_df[['Mass', 'Target', 'Element']]
-    except KeyError as e:
+    columns = ['Mass', 'Target', 'Element']
+    if not set(columns) <= set(panel_df.columns):
         print('Panel format not understood.')
-        raise e
-
-    panel_df = pd.read_csv(panel_file)
+        raise KeyError(f'{columns} not all in panel columns')
 
     if anonymize_targets:
 
         # keep only relevant columns
-        panel_df = panel_df[['Mass', 'Target', 'Element']]
+        panel_df = panel_df[columns].copy()
 
         # fill gaps
 
         # Xe 128 has typicaly the Element column empty
-        try:
-            target = panel_df['Target'][panel_df['Mass'] == 128].values[0]
-            if (target == 'Xe128' and
-                np.isnan(panel_df['Element'][panel_df['Mass'] ==
-                                             128].values[0])):
-                #print('Found Xe128') # debug
-                panel_df['Element'][panel_df['Mass'] == 128] = 'Xe'
-            else:
-                print('Could not set element to Xe')
-        except Exception as e:
-            if panel_df['Element'][panel_df['Mass'] == 128].values[0] != 'Xe':
-                print('Xe128 not found or error')
-                raise e
+        is_mass_xe = panel_df['Mass'] == 128
+        is_empty_xe = (is_mass_xe & (panel_df['Target'] == 'Xe128') &
+                       panel_df['Element'].isna())
+        if is_empty_xe.any():
+            #print('Found Xe128') # debug
+            panel_df.loc[is_empty_xe, 'Element'] = 'Xe'
+        elif not (panel_df.loc[is_mass_xe, 'Element'] == 'Xe').any():
+            print('Xe128 not found, could not set element to Xe')
 
         # encode element and mass into the target name
-        # since i need to transform masses from int to str, I cannot simply add
-        # the coumns, i need to apply a lambda funtion
-
-        panel_df['Target'] = panel_df.apply(lambda x: x['Element'] +
-                                            str(x['Mass']), axis=1)
+        panel_df['Target'] = (panel_df['Element'].astype(str) +
+                              panel_df['Mass'].astype(str))
 
     return panel_df
 
@@ -427,21 +554,13 @@ def read_isobaric_corrections(json_file, a_masses=None):
     with open(json_file) as jf:
         l_corrs = json.load(jf)
 
-    dict_corrs = {}
-    for corr in l_corrs:
-        try:
-            dict_corrs[corr['RecipientMass']].append(corr['DonorMass'])
-        except KeyError:
-            dict_corrs[corr['RecipientMass']] = [corr['DonorMass']]
+    # group donors by recipient, keeping the order of the json file
+    df_corrs = pd.DataFrame(l_corrs, columns=['RecipientMass', 'DonorMass'])
+    dict_corrs = (df_corrs.groupby('RecipientMass', sort=False)['DonorMass']
+                  .apply(list).to_dict())
 
     if a_masses is not None:
-        dict_masses = {}
-        for mass in a_masses:
-            try:
-                dict_masses[mass] = dict_corrs[mass]
-            except KeyError:
-                dict_masses[mass] = []
-        dict_corrs = dict_masses
+        dict_corrs = {mass: dict_corrs.get(mass, []) for mass in a_masses}
 
     return dict_corrs
 
@@ -486,10 +605,14 @@ def plot_1_fov(file_name, l_channel, ax=None, file_id=''):
 
     Parameters
     ----------
-    file_name : str
-        Path to MIBItiff file of the FoV to use for plotting.
+    file_name : str or `~mibidata.mibi_image.MibiImage`
+        Path to MIBItiff file of the FoV to use for plotting, or the image
+        already read from it (to plot several selections without reading the
+        file again).
     l_channel : list
-        List of channels to plot.
+        List of channels to plot, given by mass or by target. When reading the
+        file, only these channels are read, unless masses and targets are
+        mixed.
     ax : `~matplotlib.axes.Axes`, optional
         Axes of the figure for the plot.
     file_id : str, optional
@@ -502,11 +625,20 @@ def plot_1_fov(file_name, l_channel, ax=None, file_id=''):
     """
 
     print()
-    print(f'Plotting file: {file_name}')
+    if isinstance(file_name, mi.MibiImage):
+        image = file_name
+        print('Plotting image')
+    else:
+        print(f'Plotting file: {file_name}')
+        # read only the channels to plot, selected either by mass or by target
+        if all(isinstance(channel, (int, np.integer)) for channel in l_channel):
+            image = tiff.read(file_name, masses=l_channel)
+        elif all(isinstance(channel, str) for channel in l_channel):
+            image = tiff.read(file_name, targets=l_channel)
+        else:
+            image = tiff.read(file_name)
     print(f' File ID: {file_id}')
 
-    image = tiff.read(file_name)
-
     # TODO: allow target name anonymization!!!
 
     # loop over channels
@@ -525,6 +657,117 @@ def plot_1_fov(file_name, l_channel, ax=None, file_id=''):
 
     return ax
 
+
+def save_1_fov_images(file_name, out_dir, masses=None, brighten_image=True,
+                      min_counts=1):
+    """Save each channel of one FoV as a png file.
+
+    The MIBItiff file is read once and the channels are saved one after the
+    other as `<mass>_<target>.png`. Channels with fewer counts than
+    `min_counts` (by default, empty channels) are skipped.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to MIBItiff file of the FoV.
+    out_dir : str
+        Path to the output directory. It is created if it does not exist.
+    masses : list, optional
+        List of masses to save. By default, all channels are saved.
+    brighten_image: bool, optional
+        If activated, a gamma correction of 1/2 is applied to the images.
+    min_counts : int, optional
+        Minimum number of counts in a channel to save it.
+
+    Returns
+    -------
+    l_png_file : list
+        Paths to the saved png files.
+    """
+    image = tiff.read(file_name, masses=masses)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # counts of all channels in one pass over the (x, y, channel) image data
+    dict_counts = dict(zip(image.channels, image.data.sum(axis=(0, 1))))
+
+    l_png_file = []
+    scratch = None
+    for mass, target in sorted(image.channels):
+        if dict_counts[(mass, target)] < min_counts:
+            continue
+        # the channels are interleaved in the image data, so copy the channel
+        # once into contiguous memory for the gamma and color passes
+        im = np.ascontiguousarray(image[mass])
+        if scratch is None:
+            # all channels of a FoV have the same shape
+            scratch = make_scratch(im.shape)
+        png_file = os.path.join(out_dir, f'{mass}_{target}.png')
+        save_image(im, png_file, brighten_image=brighten_image,
+                   scratch=scratch)
+        l_png_file.append(png_file)
+
+    return l_png_file
+
+
+def save_fov_images(l_file_name, out_dir, masses=None, brighten_image=True,
+                    min_counts=1, max_workers=None):
+    """Save each channel of several FoVs as png files in parallel.
+
+    Each FoV is processed by `save_1_fov_images(...)` in its own worker
+    process, and its images are saved in the subdirectory
+    `<parent folder>/<file name>` of `out_dir`, named after the MIBItiff file
+    and its folder (the processing stages use the same file names in different
+    folders).
+
+    Parameters
+    ----------
+    l_file_name : list
+        Paths to the MIBItiff files of the FoVs.
+    out_dir : str
+        Path to the output directory.
+    masses : list, optional
+        List of masses to save. By default, all channels are saved.
+    brighten_image: bool, optional
+        If activated, a gamma correction of 1/2 is applied to the images.
+    min_counts : int, optional
+        Minimum number of counts in a channel to save it.
+    max_workers : int, optional
+        Number of worker processes. By default, the number of CPUs.
+
+    Returns
+    -------
+    dict_png_files : dict
+        Paths to the saved png files for each MIBItiff file.
+
+    Raises
+    ------
+    ValueError
+        If two MIBItiff files would be saved in the same subdirectory.
+    """
+    # the workers must not write to the same files
+    dict_fov_dirs = {}
+    set_fov_dirs = set()
+    for file_name in l_file_name:
+        folder_path, tiff_name = os.path.split(os.path.abspath(file_name))
+        fov_dir = os.path.join(out_dir, os.path.basename(folder_path),
+                               os.path.splitext(tiff_name)[0])
+        if fov_dir in set_fov_dirs:
+            raise ValueError(f'{file_name} would be saved in {fov_dir} '
+                             f'together with another file')
+        set_fov_dirs.add(fov_dir)
+        dict_fov_dirs[file_name] = fov_dir
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        dict_futures = {}
+        for file_name, fov_dir in dict_fov_dirs.items():
+            dict_futures[file_name] = executor.submit(
+                save_1_fov_images, file_name, fov_dir, masses, brighten_image,
+                min_counts)
+        dict_png_files = {file_name: future.result()
+                          for file_name, future in dict_futures.items()}
+
+    return dict_png_files
+
 ###########################################################################
 
 def main():
@@ -535,11 +778,13 @@ def main():
     one FoV and each column represents a channel.
 
     Activate the global variable 'SAVE' in order to save the figure as a png
-    file.
+    file, and 'SAVE_PNGS' in order to save each channel of each FoV as a
+    separate png file.
     """
 
     data_path = os.path.expanduser('~/common/path/to/data')
     l_file_name = []
+    l_image = []
     l_file_label = []
 
     print()
@@ -549,6 +794,7 @@ def main():
     print(f'metadata {image.metadata}')
     print(f'channels {image.channels}')
     l_file_name.append(tiff_file)
+    l_image.append(image)
     l_file_label.append('file')
 
     print()
@@ -569,6 +815,7 @@ def main():
     print(f'metadata {image.metadata}')
     print(f'channels {image.channels}')
     l_file_name.append(tiff_file)
+    l_image.append(image)
     l_file_label.append('matlab_file')
 
     l_channel = [89, 113, 115, 128, 146, 197]
@@ -586,14 +833,11 @@ def main():
                                     figsize*n_files_to_plot))
 
     # loop over files and produce the plots
-    count_files = 0;
-    for tiff_file_name, file_label in zip(l_file_name, l_file_label):
-        if count_files < n_files_to_plot:
-            #plot_1_fov(tiff_file_name, l_channel, ax[count_files],
-            #           file_id=count_files)
-            plot_1_fov(tiff_file_name, l_channel, ax[count_files],
-                       file_id=file_label)
-        count_files += 1
+    # (the images already read are plotted, instead of reading the files again)
+    for count_files, (image, file_label) in enumerate(zip(l_image,
+                                                          l_file_label)):
+        #plot_1_fov(image, l_channel, ax[count_files], file_id=count_files)
+        plot_1_fov(image, l_channel, ax[count_files], file_id=file_label)
 
     # save ouptut
     if SAVE:
@@ -602,6 +846,12 @@ def main():
         print(f'Saving image to {output_file_name}')
         plt.savefig(output_file_name)
 
+    if SAVE_PNGS:
+        png_dir = 'channel_images'
+        print()
+        print(f'Saving channel images to {png_dir}')
+        save_fov_images(l_file_name, png_dir, masses=l_channel)
+
     if GRAPH_DEBUG > 1:
         plt.show() # don't leave at the end
 